@@ -6,225 +6,274 @@ import numpy as np
 import argparse
 #import osmium
 #import shapely.wkb as wkblib
-import xml.etree.ElementTree as ET
-from rtree import index
+from xml.parsers import expat
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import logging
 from logging import debug
-import random
+from array import array
 
 # Definitions
-WAY_TYPES = ["motorway", "trunk", "primary", "secondary", "tertiary",
-             "unclassified", "residential", "service", "living_street"]
+WAY_TYPES = frozenset({"motorway", "trunk", "primary", "secondary", "tertiary",
+             "unclassified", "residential", "service", "living_street"})
+EARTH_RADIUS = 6378137 # meters, as in the web mercator projection
 
 ##########################################################
-def get_all_nodes(root, invways):
-    """Get all nodes in the xml struct
+def parse_osm(osmpath):
+    """Get all ways and their nodes in a single streaming pass over the osm
+    file, using expat callbacks instead of building an element tree.
+    Nodes precede ways in the osm file, thus the coordinates of all nodes are
+    kept, in flat typed buffers, until the ways are known.
 
     Args:
-    root(ET): root element 
+    osmpath(str): path to the osm file
 
     Returns:
-    rtree.index: rtree of the nodes
-    invways(dict): inverted list of ways, i.e., node as key and list of way ids as values
+    dict of np.array: wayid as key and an ordered array of nodeids as values
+    3-uple of np.array: inverted list of ways (nodeids, offsets, wayids)
+    3-uple of np.array: nodes table (ids, lats, lons) sorted by id
     """
-    valid = invways.keys()
-    nodesidx = index.Index()
-    coords = {}
+    ways = {}
+    ids, lats, lons = array('q'), array('d'), array('d')
+
+    wayid = None # way being parsed
+    isstreet = False
+    nodes = []
+    ndappend = nodes.append
+
+    # Hot path: most frequent elements first and builtins/methods bound locally
+    def start_element(name, attrs, int=int, float=float, waytypes=WAY_TYPES,
+                      idappend=ids.append, latappend=lats.append,
+                      lonappend=lons.append):
+        nonlocal wayid, isstreet, nodes, ndappend
+        if name == 'nd': # only found inside ways, parsed if the way is a street
+            ndappend(attrs['ref'])
+        elif name == 'node':
+            idappend(int(attrs['id']))
+            latappend(float(attrs['lat']))
+            lonappend(float(attrs['lon']))
+        elif name == 'tag':
+            if wayid is None: return # tag of a node or relation
+            # Found a street segment
+            if attrs.get('k') == 'highway' and attrs.get('v') in waytypes:
+                isstreet = True
+        elif name == 'way':
+            wayid = int(attrs['id'])
+            isstreet = False
+            nodes = []
+            ndappend = nodes.append
+
+    def end_element(name):
+        nonlocal wayid
+        if name != 'way': return
+
+        if isstreet: ways[wayid]  = np.array(nodes, dtype=np.int64)
+        wayid = None
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    with open(osmpath, 'rb') as fh:
+        parser.ParseFile(fh)
+
+    # Keep only the nodes referenced by the ways
+    invways = get_invways(ways)
+    refs = invways[0]
+    ids = np.frombuffer(ids, dtype=np.int64)
+    valid = np.flatnonzero(np.isin(ids, refs))
+    valid = valid[np.argsort(ids[valid], kind='stable')]
+    nodestable = (ids[valid], np.frombuffer(lats, dtype=np.float64)[valid],
+                  np.frombuffer(lons, dtype=np.float64)[valid])
+
+    # Nodes referenced inside ways (<nd ref>) but absent from the file
+    orphans = np.setdiff1d(refs, nodestable[0])
+    if len(orphans):
+        for wayid, nodes in ways.items():
+            ways[wayid] = nodes[~np.isin(nodes, orphans)]
+        invways = get_invways(ways)
+    return ways, invways, nodestable
 
-    #debug('Valid (inside get_all_nodes):{}'.format(len(valid)))
-    for child in root:
-        if child.tag != 'node': continue # not node
-        if int(child.attrib['id']) not in valid: continue # non relevant node
+##########################################################
+def get_invways(ways):
+    """Build the inverted list of ways. A single np.unique over the flat
+    nodes references gives both the referenced nodes and their degree.
 
-        att = child.attrib
-        lat, lon = float(att['lat']), float(att['lon'])
-        nodesidx.insert(int(att['id']), (lat, lon, lat, lon))
-        coords[int(att['id'])] = (lat, lon)
+    Args:
+    ways(dict of np.array): wayid as key and an ordered array of nodeids as values
 
-    return nodesidx, coords
+    Returns:
+    3-uple of np.array: inverted list of ways in CSR layout
+    (nodeids, offsets, wayids), the ways of nodeids[i] being
+    wayids[offsets[i]:offsets[i+1]]
+    """
+    lens = np.fromiter((len(nodes) for nodes in ways.values()), dtype=np.int64,
+                       count=len(ways))
+    refs = np.concatenate([np.empty(0, dtype=np.int64), *ways.values()])
+    wayids = np.repeat(np.fromiter(ways, dtype=np.int64,
+                                   count=len(ways)), lens)
+
+    # Group the (node, way) pairs by node, keeping the ways order
+    order = np.argsort(refs, kind='stable')
+    refs, wayids = refs[order], wayids[order]
+    nodeids, degrees = np.unique(refs, return_counts=True)
+    offsets = np.zeros(len(nodeids) + 1, dtype=np.int64)
+    np.cumsum(degrees, out=offsets[1:])
+    return nodeids, offsets, wayids
 
 ##########################################################
-def get_all_ways(root):
-    """Get all ways in the xml struct
+def get_nodes_idx(nodestable, nodeids):
+    """Get the position of the nodes in the nodes table
 
     Args:
-    root(ET): root element 
+    nodestable(3-uple of np.array): (ids, lats, lons) sorted by id
+    nodeids(np.array): nodes ids, all of them present in the table
 
     Returns:
-    rtree.index: rtree of the nodes
+    np.array: indices of the nodes in the table
     """
-    ways = {}
-    invways = {} # inverted list of ways
+    ids = nodestable[0]
+    return np.searchsorted(ids, nodeids)
 
-    #total=0
-    nodesset = set()
-    for way in root:
-        if way.tag != 'way': continue
-        wayid = int(way.attrib['id'])
-        isstreet = False
-        nodes = []
+##########################################################
+def get_node_ways(invways, nodeid):
+    """Get the ways containing a node from the inverted list of ways
 
-        nodes = []
-        for child in way:
-            if child.tag == 'nd':
-                nodes.append(int(child.attrib['ref']))
-            elif child.tag == 'tag':
-                # Found a street segment
+    Args:
+    invways(3-uple of np.array): inverted list of ways (nodeids, offsets, wayids)
+    nodeid(int): node id
 
-                #if child.attrib['k'] == 'highway': # TODO: REMOVE IT
-                if child.attrib['k'] == 'highway' and child.attrib['v'] in WAY_TYPES:
-                    isstreet = True
+    Returns:
+    np.array: view of the ids of the ways containing the node, empty if the
+    node is not referenced by any way
+    """
+    nodeids, offsets, wayids = invways
+    i = np.searchsorted(nodeids, nodeid)
+    if i == len(nodeids) or nodeids[i] != nodeid: return wayids[:0]
+    return wayids[offsets[i]:offsets[i + 1]]
 
-        if isstreet:
-            ways[wayid]  = nodes
-            #total += len(nodes)
+##########################################################
+def get_nodes_rtree(nodestable):
+    """Bulk load an rtree with the nodes coordinates
 
-            for node in nodes:
-                if node in invways.keys(): invways[node].append(wayid)
-                else: invways[node] = [wayid]
-                nodesset.add(node)
+    Args:
+    nodestable(3-uple of np.array): (ids, lats, lons) sorted by id
 
-    #debug('Number of nodes in get_all_ways:{}'.format(len(nodesset)))
+    Returns:
+    rtree.index: rtree of the nodes
+    """
+    from rtree import index
+    ids, lats, lons = nodestable
+    if len(ids) == 0: return index.Index() # bulk loader refuses empty streams
 
-    return ways, invways
+    stream = ((nid, (lat, lon, lat, lon), None)
+              for nid, lat, lon in zip(ids.tolist(), lats.tolist(), lons.tolist()))
+    return index.Index(stream)
 
 ##########################################################
 def idx2array_nodes(nodes_rtree):
     bounds = nodes_rtree.bounds
     nodeslist = list(nodes_rtree.intersection(bounds, objects=True))
-    npoints = len(nodeslist)
-
-    nodes = np.ndarray((npoints, 2))
-
-    for i, node in enumerate(nodeslist):
-        nodes[i, 0] = node.bbox[0]
-        nodes[i, 1] = node.bbox[1]
-
+    nodes = np.asarray([(node.bbox[0], node.bbox[1]) for node in nodeslist],
+                       dtype=np.float64).reshape(-1, 2)
     return nodes
 
 ##########################################################
-def render_map(nodeshash, ways, crossings, frontend='bokeh'):
+def render_map(nodestable, ways, crossings, frontend='bokeh'):
     if frontend == 'matplotlib':
-        render_matplotlib(nodeshash, ways, crossings)
+        render_matplotlib(nodestable, ways, crossings)
     else:
-        render_bokeh(nodeshash, ways, crossings)
+        render_bokeh(nodestable, ways, crossings)
 
 ##########################################################
-def get_nodes_coords_from_hash(nodeshash):
-    """Get nodes coordinates and discard nodes ids information
+def get_nodes_xy(nodestable):
+    """Project the nodes coordinates, in a single pass over the lat/lon
+    arrays, to spherical (web) mercator
     Args:
-    nodeshash(dict): nodeid as key and (x, y) as value
+    nodestable(3-uple of np.array): (ids, lats, lons) sorted by id
 
     Returns:
-    np.array(n, 2): Return a two-column table containing all the coordinates
+    np.array(n, 2): Return a two-column table containing the (x, y), in meters
     """
 
-    nnodes = len(nodeshash.keys())
-    nodes = np.ndarray((nnodes, 2))
-
-    for j, coords in enumerate(nodeshash.values()):
-        nodes[j, 0] = coords[0]
-        nodes[j, 1] = coords[1]
-    return nodes
+    _, lats, lons = nodestable
+    xy = np.empty((len(lats), 2))
+    np.multiply(np.radians(lons), EARTH_RADIUS, out=xy[:, 0])
+    np.multiply(np.log(np.tan(np.pi / 4 + np.radians(lats) / 2)), EARTH_RADIUS,
+                out=xy[:, 1])
+    return xy
 
 ##########################################################
-def get_crossings(invways):
-    crossings = set()
-    for nodeid, waysids in invways.items():
-        if len(waysids) > 1:
-            crossings.add(nodeid)
-    return crossings
-
-def filter_out_orphan_nodes(ways, invways, nodeshash):
-    """Check consistency of nodes in invways and nodeshash and fix them in case
-    of inconsistency
-    It can just be explained by the *non* exitance of nodes, even though they are
-    referenced inside ways (<nd ref>)
-
+def get_ways_coords(nodestable, nodesxy, ways):
+    """Get the coordinates of the nodes of each way
     Args:
-    invways(dict of list): nodeid as key and a list of wayids as values
-    nodeshash(dict of 2-uple): nodeid as key and (x, y) as value
-    ways(dict of list): wayid as key and an ordered list of nodeids as values
+    nodestable(3-uple of np.array): (ids, lats, lons) sorted by id
+    nodesxy(np.array(n, 2)): projected coordinates of the nodes in the table
+    ways(dict of np.array): wayid as key and an ordered array of nodeids as values
 
     Returns:
-    dict of list, dict of lists
+    list of np.array(n, 2): (x, y) of the nodes of each way
     """
-    ninvways = len(invways.keys())
-    nnodeshash = len(nodeshash.keys())
-    if ninvways == nnodeshash: return 
 
-    validnodes = set(nodeshash.keys())
+    return [ nodesxy[get_nodes_idx(nodestable, wnodes)] for wnodes in ways.values() ]
 
-    # Filter ways
-    for wayid, nodes in ways.items():
-        newlist = [ nodeid for nodeid in nodes if nodeid in validnodes ]
-        ways[wayid] = newlist
-        
-    # Filter invways
-    invwaysnodes = set(invways.keys())
-    invalid = invwaysnodes.difference(validnodes)
+##########################################################
+def get_ways_colors(nways):
+    """Get a random color for each way
+    Args:
+    nways(int): number of ways
 
-    for nodeid in invalid:
-        del invways[nodeid]
+    Returns:
+    np.array(n, 3): RGB color of each way
+    """
 
-    ninvways = len(invways.keys())
-    return ways, invways
+    return np.random.randint(0, 256, size=(nways, 3), dtype=np.uint8)
 
+##########################################################
+def get_crossings(invways):
+    nodeids, offsets, _ = invways
+    return nodeids[np.diff(offsets) > 1]
 
 ##########################################################
-def render_matplotlib(nodeshash, ways, crossings):
+def render_matplotlib(nodestable, ways, crossings):
     # render nodes
-    nodes = get_nodes_coords_from_hash(nodeshash)
-    plt.scatter(nodes[:, 1], nodes[:, 0], c='blue', alpha=1, s=20)
+    nodes = get_nodes_xy(nodestable)
+    plt.scatter(nodes[:, 0], nodes[:, 1], c='blue', alpha=1, s=20)
 
     # render ways
-    for wnodes in ways.values():
-        r = lambda: random.randint(0,255)
-        waycolor = '#%02X%02X%02X' % (r(),r(),r())
-        lats = []; lons = []
-        for nodeid in wnodes:
-            a, o = nodeshash[nodeid]
-            lats.append(a)
-            lons.append(o)
-        plt.plot(lons, lats, linewidth=2, color=waycolor)
+    waysxy = get_ways_coords(nodestable, nodes, ways)
+    ax = plt.gca()
+    waycolors = get_ways_colors(len(waysxy)) / 255.0
+    ax.add_collection(LineCollection(waysxy, linewidths=2, colors=waycolors))
+    ax.autoscale_view()
 
     # render crossings
-    crossingscoords = np.ndarray((len(crossings), 2))
-    for j, crossing in enumerate(crossings):
-        crossingscoords[j, :] = np.array(nodeshash[crossing])
-    plt.scatter(crossingscoords[:, 1], crossingscoords[:, 0], c='black')
+    crossingscoords = nodes[get_nodes_idx(nodestable, crossings)]
+    plt.scatter(crossingscoords[:, 0], crossingscoords[:, 1], c='black')
     #plt.axis('equal')
     plt.show()
 
 ##########################################################
-def render_bokeh(nodeshash, ways, crossings):
-    nodes = get_nodes_coords_from_hash(nodeshash)
+def render_bokeh(nodestable, ways, crossings):
+    nodes = get_nodes_xy(nodestable)
 
     from bokeh.plotting import figure, show, output_file
     TOOLS="hover,pan,wheel_zoom,reset"
     p = figure(tools=TOOLS)
 
     # render nodes
-    p.scatter(nodes[:, 1], nodes[:, 0], size=10, fill_alpha=0.8,
+    p.scatter(nodes[:, 0], nodes[:, 1], size=10, fill_alpha=0.8,
                         line_color=None)
 
     # render ways
-    for wnodes in ways.values():
-        r = lambda: random.randint(0,255)
-        waycolor = '#%02X%02X%02X' % (r(),r(),r())
-        lats = []; lons = []
-        for nodeid in wnodes:
-            a, o = nodeshash[nodeid]
-            lats.append(a)
-            lons.append(o)
-        p.line(lons, lats, line_width=2, line_color=waycolor)
+    waysxy = get_ways_coords(nodestable, nodes, ways)
+    waycolors = ['#%02X%02X%02X' % tuple(rgb)
+                 for rgb in get_ways_colors(len(waysxy)).tolist()]
+    p.multi_line([w[:, 0] for w in waysxy], [w[:, 1] for w in waysxy],
+                 line_width=2, line_color=waycolors)
 
     # render crossings
-    crossingscoords = np.ndarray((len(crossings), 2))
-    for j, crossing in enumerate(crossings):
-        crossingscoords[j, :] = np.array(nodeshash[crossing])
-    p.scatter(crossingscoords[:, 1], crossingscoords[:, 0], line_color='black')
+    crossingscoords = nodes[get_nodes_idx(nodestable, crossings)]
+    p.scatter(crossingscoords[:, 0], crossingscoords[:, 1], line_color='black')
 
     output_file("osm-test.html", title="OSM test")
 
@@ -247,14 +296,9 @@ def main():
 
     logging.basicConfig(level=loglevel)
 
-    tree = ET.parse(args.inputosm)
-    root = tree.getroot() # Tag osm
-
-    ways, invways = get_all_ways(root)
-    nodestree, nodeshash = get_all_nodes(root, invways)
-    ways, invways = filter_out_orphan_nodes(ways, invways, nodeshash)
+    ways, invways, nodestable = parse_osm(args.inputosm)
     crossings = get_crossings(invways)
-    render_map(nodeshash, ways, crossings, args.frontend)
+    render_map(nodestable, ways, crossings, args.frontend)
     
 ##########################################################
 if __name__ == '__main__':